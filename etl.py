@@ -1,64 +1,299 @@
-import pandas as pd
+import argparse
+import glob
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyreadstat
+from pyarrow import csv as pa_csv
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType, DateType
+
+logger = logging.getLogger('etl')
+
+# Print row counts of the intermediate tables (every count triggers a separate Spark job)
+VERBOSE = False
+
+# Schemas of the dictionary tables derived from I94_SAS_Labels_Descriptions.SAS
+COUNTRY_SCHEMA = StructType([StructField('code', LongType()), StructField('country_name', StringType())])
+PORT_SCHEMA = StructType([StructField('code', StringType()), StructField('port_location', StringType()),
+                          StructField('state', StringType())])
+MODE_SCHEMA = StructType([StructField('code', LongType()), StructField('border_cross_method', StringType())])
+VISA_SCHEMA = StructType([StructField('code', LongType()), StructField('visa_type', StringType())])
+STATES_SCHEMA = StructType([StructField('code', StringType()), StructField('state', StringType())])
+
+# Schemas of the supplementary datasets (final data types are set by the readers to avoid inference and casts)
+CITIES_POP_SCHEMA = StructType([
+    StructField('city', StringType()),
+    StructField('state', StringType()),
+    StructField('median_age', DoubleType()),
+    StructField('male_population', LongType()),
+    StructField('female_population', LongType()),
+    StructField('total_population', LongType()),
+    StructField('number_of_veterans', LongType()),
+    StructField('foreign_born', LongType()),
+    StructField('avg_household_size', DoubleType()),
+    StructField('state_code', StringType()),
+    StructField('race', StringType()),
+    StructField('count', LongType())
+])
+AIRPORTS_SCHEMA = StructType([
+    StructField('ident', StringType()),
+    StructField('type', StringType()),
+    StructField('name', StringType()),
+    StructField('elevation_ft', LongType()),
+    StructField('continent', StringType()),
+    StructField('iso_country', StringType()),
+    StructField('iso_region', StringType()),
+    StructField('municipality', StringType()),
+    StructField('gps_code', StringType()),
+    StructField('iata_code', StringType()),
+    StructField('local_code', StringType()),
+    StructField('coordinates', StringType())
+])
+WEATHER_SCHEMA = StructType([
+    StructField('dt', DateType()),
+    StructField('AverageTemperature', DoubleType()),
+    StructField('AverageTemperatureUncertainty', DoubleType()),
+    StructField('City', StringType()),
+    StructField('Country', StringType()),
+    StructField('Latitude', StringType()),
+    StructField('Longitude', StringType())
+])
+
+# Row group size of the parquet files in the data lake (smaller row groups for the dimension tables)
+PARQUET_BLOCK_SIZE = 128 * 1024 * 1024
+DIM_PARQUET_BLOCK_SIZE = 64 * 1024 * 1024
+# Number of write tasks for the (small) dimension tables
+DIM_WRITE_PARTITIONS = 4
+
+# Arrow counterparts of the Spark data types used in the schemas above
+ARROW_TYPES = {
+    'string': pa.string(),
+    'bigint': pa.int64(),
+    'double': pa.float64(),
+    'date': pa.date32()
+}
+
+
+def arrow_csv_options(delimiter=',', schema=None):
+    """
+    - Build options of the native Arrow CSV reader for given delimiter
+    - Apply given schema to the parsed columns (column types are inferred if schema is omitted)
+    
+    Return:
+    - Dictionary of read, parse and convert options for pa_csv.read_csv / pa_csv.open_csv
+    """
+    # Only empty values are treated as nulls (same as in Spark CSV reader)
+    read_options = pa_csv.ReadOptions(block_size=64 << 20)
+    convert_options = pa_csv.ConvertOptions(null_values=[''], strings_can_be_null=True)
+    if schema is not None:
+        # Replace header names with schema field names and skip type inference
+        read_options = pa_csv.ReadOptions(block_size=64 << 20, column_names=schema.fieldNames(), skip_rows=1)
+        convert_options = pa_csv.ConvertOptions(null_values=[''], strings_can_be_null=True,
+                                                column_types={f.name: ARROW_TYPES[f.dataType.simpleString()]
+                                                              for f in schema.fields})
+    return {'read_options': read_options, 'parse_options': pa_csv.ParseOptions(delimiter=delimiter),
+            'convert_options': convert_options}
+
+
+def parse_csv_arrow(path, delimiter=',', schema=None):
+    """
+    - Parse CSV file with the native Arrow reader instead of the Spark CSV parser
+    - Apply given schema to the parsed columns (column types are inferred if schema is omitted)
+    
+    Return:
+    - Arrow table with the content of CSV file
+    """
+    return pa_csv.read_csv(path, **arrow_csv_options(delimiter, schema))
+
+
+def read_csv_arrow(spark, path, delimiter=',', schema=None):
+    """
+    - Parse CSV file with the native Arrow reader
+    - Convert parsed Arrow table into Spark dataframe
+    
+    Return:
+    - Spark dataframe with the content of CSV file
+    """
+    table = parse_csv_arrow(path, delimiter, schema)
+    # Spark 4 accepts Arrow tables directly, older versions get pandas dataframe
+    # (integer columns with nulls are kept as Python ints instead of float NaN to pass LongType schema verification)
+    if int(spark.version.split('.')[0]) >= 4:
+        return spark.createDataFrame(table, schema=schema)
+    return spark.createDataFrame(table.to_pandas(integer_object_nulls=True), schema=schema)
+
+
+def csv_to_parquet(path_csv, path_pq, schema, delimiter=','):
+    """
+    - Stream large CSV file through the native Arrow reader using given schema
+      (one 64MB block is parsed at a time, the file is never loaded into memory as a whole)
+    - Save parsed data into parquet file (snappy compressed, one row group per block),
+      so Spark reads columnar data instead of CSV
+      (file is written under temporary name and renamed when complete, so interrupted conversion is not reused)
+    """
+    reader = pa_csv.open_csv(path_csv, **arrow_csv_options(delimiter, schema))
+    with pq.ParquetWriter(path_pq + '.tmp', reader.schema, compression='snappy') as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+    os.replace(path_pq + '.tmp', path_pq)
+
+
+def sas_to_parquet(path_sas, path_pq):
+    """
+    - Parse SAS file with pyreadstat using all available CPU cores
+    - Save parsed data into parquet file (snappy compressed), so Spark reads columnar data instead of SAS format
+      (file is written under temporary name and renamed when complete, so interrupted conversion is not reused)
+    """
+    df, _ = pyreadstat.read_file_multiprocessing(pyreadstat.read_sas7bdat, path_sas, num_processes=os.cpu_count())
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path_pq + '.tmp',
+                   compression='snappy', row_group_size=1_000_000)
+    os.replace(path_pq + '.tmp', path_pq)
+
+
+def staging_path(staging_data, key, path):
+    """
+    - Hash path, modification time and size of the local source file (file content is not read)
+    - Build path of the parquet staging file in the local staging directory,
+      so converted data is reused until the source changes
+    
+    Return:
+    - Local path of the staging file
+    """
+    stat = os.stat(path)
+    digest = hashlib.blake2b(f'{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}'.encode(),
+                             digest_size=16).hexdigest()
+    return os.path.join(staging_data, f'{key}_{digest}.parquet')
+
+
+def remove_stale_staging(staging_data, key, path_pq):
+    """
+    - Remove staging files of the previous versions of the source (all '<key>_*.parquet' files except given one)
+    """
+    for stale_path in glob.glob(os.path.join(staging_data, f'{key}_*.parquet')):
+        if stale_path != path_pq:
+            os.remove(stale_path)
+
 
-def load_source_data(spark, input_data, output_data):
+def dict_to_map(df, key_col, value_col):
+    """
+    - Collect small dictionary table on the driver
+    - Build inlined map expression (code -> name) to translate codes without joining with the table
+    
+    Return:
+    - Spark map column
+    """
+    # Keys are cast to the type of the key column (Python ints would become IntegerType literals,
+    # which don't match LongType lookups in ANSI mode)
+    key_type = df.schema[key_col].dataType
+    return F.create_map([x for row in df.collect()
+                         for x in (F.lit(row[key_col]).cast(key_type), F.lit(row[value_col]))])
+
+
+def write_parquet(df, path, partition_cols, repartition_cols=None, block_size=PARQUET_BLOCK_SIZE,
+                  num_partitions=None, dynamic_overwrite=False):
+    """
+    - Repartition dataframe by partition columns (or by given repartition columns),
+      so every task writes a few large files instead of many small ones
+    - Limit number of write tasks to num_partitions, if given (for small tables, independently
+      of spark.sql.shuffle.partitions), every partition value is still written by a single task
+    - Every task keeps concurrent writers for its (few) partitions open, so rows don't need to be sorted
+      by partition columns (see spark.sql.maxConcurrentOutputFileWriters)
+    - Save dataframe to the data lake in parquet format (zstd compressed, with given row group size)
+    - Replace only the partitions present in dataframe, if dynamic_overwrite is set
+      (otherwise the whole output directory is replaced)
+    """
+    hash_cols = repartition_cols or partition_cols
+    df = df.repartition(num_partitions, *hash_cols) if num_partitions else df.repartition(*hash_cols)
+    df.write.partitionBy(*partition_cols).mode('overwrite').\
+                    option('partitionOverwriteMode', 'dynamic' if dynamic_overwrite else 'static').\
+                    option('compression', 'zstd').option('parquet.block.size', block_size).\
+                    option('parquet.page.size', 1024 * 1024).\
+                    parquet(path)
+
+
+def load_source_data(spark, input_data, output_data, checkpoint=False):
     """
     - Load all required datasets in various formats from external data sources
     - Narrow datasets and create schema for source tables
-    - Save raw source data tables to the S3 data lake (in parquet format)
+    - Save raw source data tables to the S3 data lake (in parquet format), if checkpoint is set
+    
+    Return:
+    - List of source tables (i94, demographic, weather and airports) for the next step of pipeline
     """
-    print('Step 1 - Data extraction from external sources - started.')
-    print()
-    print('Reading dictionary tables...')
+    logger.info('Step 1 - Data extraction from external sources - started.')
+    logger.info('Reading dictionary tables...')
     # Read in country dictionary from 'countries.csv'
-    country_df = spark.read.option("header", True).option("delimiter", ";").csv(input_data['dict_tables'] + 'countries.csv')
-    print(f'{country_df.toPandas().shape[0]:,d} records were successfully loaded from countries.csv')
+    country_df = read_csv_arrow(spark, input_data['dict_tables'] + 'countries.csv', ';', COUNTRY_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{country_df.count():,d} records were successfully loaded from countries.csv')
     # Read in port dictionary from 'i94ports.csv'
-    port_df = spark.read.option("header", True).option("delimiter", ";").csv(input_data['dict_tables'] + 'i94ports.csv')
-    print(f'{port_df.toPandas().shape[0]:,d} records were successfully loaded from i94ports.csv')
+    port_df = read_csv_arrow(spark, input_data['dict_tables'] + 'i94ports.csv', ';', PORT_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{port_df.count():,d} records were successfully loaded from i94ports.csv')
     # Read in port dictionary from 'i94mode.csv'
-    mode_df = spark.read.option("header", True).option("delimiter", ";").csv(input_data['dict_tables'] + 'i94mode.csv')
-    print(f'{mode_df.toPandas().shape[0]:,d} records were successfully loaded from i94mode.csv')
+    mode_df = read_csv_arrow(spark, input_data['dict_tables'] + 'i94mode.csv', ';', MODE_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{mode_df.count():,d} records were successfully loaded from i94mode.csv')
     # Read in port dictionary from 'i94visa.csv'
-    visa_df = spark.read.option("header", True).option("delimiter", ";").csv(input_data['dict_tables'] + 'i94visa.csv')
-    print(f'{visa_df.toPandas().shape[0]:,d} records were successfully loaded from i94visa.csv')
+    visa_df = read_csv_arrow(spark, input_data['dict_tables'] + 'i94visa.csv', ';', VISA_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{visa_df.count():,d} records were successfully loaded from i94visa.csv')
     # Read in port dictionary from 'us_states.csv'
-    states_df = spark.read.option("header", True).option("delimiter", ";").csv(input_data['dict_tables'] + 'us_states.csv')
-    print(f'{states_df.toPandas().shape[0]:,d} records were successfully loaded from us_states.csv')
+    states_df = read_csv_arrow(spark, input_data['dict_tables'] + 'us_states.csv', ';', STATES_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{states_df.count():,d} records were successfully loaded from us_states.csv')
     
-    print('Reading i94 immigration dataset...')
-    # Read in i94 immigration SAS data
-    i94_full_df = spark.read.format('com.github.saurfang.sas.spark').load(input_data['i_94_immig'])
-    print(f'{i94_full_df.count():,d} records were successfully loaded from i94 immigration dataset.')
-
-    print('Reading U.S. cities demographics dataset...')
-    cities_pop_df = spark.read.option("header", True).option("delimiter", ";").csv(input_data['demographic'] + 'us-cities-demographics.csv')
-    cities_pop_df = cities_pop_df.toDF('city', 'state', 'median_age', 'male_population', 'female_population', 'total_population', 'number_of_veterans',
-                                      'foreign_born', 'avg_household_size', 'state_code', 'race', 'count')
-    print(f'{cities_pop_df.count():,d} records were successfully loaded from U.S. cities demographics dataset.')
+    logger.info('Reading i94 immigration dataset...')
+    # Read in i94 immigration data (converted from SAS format into parquet before the pipeline starts)
+    i94_full_df = spark.read.parquet(input_data['i_94_immig'])
+    if VERBOSE:
+        logger.info(f'{i94_full_df.count():,d} records were successfully loaded from i94 immigration dataset.')
+
+    logger.info('Reading U.S. cities demographics dataset...')
+    cities_pop_df = read_csv_arrow(spark, input_data['demographic'] + 'us-cities-demographics.csv', ';', CITIES_POP_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{cities_pop_df.count():,d} records were successfully loaded from U.S. cities demographics dataset.')
     
-    print('Reading airport codes dataset...')
-    airports_df = spark.read.option("header", True).csv(input_data['airports'] + 'airport-codes_csv.csv')
-    print(f'{airports_df.count():,d} records were successfully loaded from airport codes dataset.')
+    logger.info('Reading airport codes dataset...')
+    airports_df = read_csv_arrow(spark, input_data['airports'] + 'airport-codes_csv.csv', ',', AIRPORTS_SCHEMA)
+    if VERBOSE:
+        logger.info(f'{airports_df.count():,d} records were successfully loaded from airport codes dataset.')
     
-    print('Reading global temperatures by cities dataset...')
-    weather_df = spark.read.option("header", True).csv(input_data['temperature'])
-    print(f'{weather_df.count():,d} records were successfully loaded from global temperatures by cities dataset.')
+    logger.info('Reading global temperatures by cities dataset...')
+    # Read in temperature data (converted from CSV format into parquet before the pipeline starts),
+    # explicit schema keeps the column types stable and skips schema discovery of the parquet footers
+    weather_df = spark.read.schema(WEATHER_SCHEMA).parquet(input_data['temperature'])
+    if VERBOSE:
+        logger.info(f'{weather_df.count():,d} records were successfully loaded from global temperatures by cities dataset.')
+
+    # Country, border cross method, visa type and state dictionaries contain just a few hundred rows,
+    # so we translate codes with inlined map lookups instead of joining i94 data with these tables
+    country_map = dict_to_map(country_df, 'code', 'country_name')
+    mode_map = dict_to_map(mode_df, 'code', 'border_cross_method')
+    visa_map = dict_to_map(visa_df, 'code', 'visa_type')
+    states_map = dict_to_map(states_df, 'code', 'state')
+    i94_full_df = i94_full_df.select('*',
+                                     country_map[F.col('i94res').cast('long')].alias('res_country_name'),
+                                     country_map[F.col('i94cit').cast('long')].alias('cit_country_name'),
+                                     mode_map[F.col('i94mode').cast('long')].alias('border_cross_method'),
+                                     visa_map[F.col('i94visa').cast('long')].alias('visa_type'))
+    port_df = port_df.select('*', states_map[F.col('state')].alias('state_name'))
 
     # create a temporary views against which you can run SQL queries
     i94_full_df.createOrReplaceTempView("i94_table")
-    country_df.createOrReplaceTempView("country_table")
     port_df.createOrReplaceTempView("port_table")
-    mode_df.createOrReplaceTempView("mode_table")
-    visa_df.createOrReplaceTempView("visa_table")
-    states_df.createOrReplaceTempView("states_df")
     cities_pop_df.createOrReplaceTempView("cities_pop_table")
     airports_df.createOrReplaceTempView("airports_table")
     weather_df.createOrReplaceTempView("weather_table")
 
     # narrow datasets and create schema for source tables
-    print()
-    print('Narrowing datasets and creating correct schema for each source table...')
+    logger.info('Narrowing datasets and creating correct schema for each source table...')
     # For i94_source_table we perform following tasks:
     # 1. Set correct data types for the fields
     # 2. Translate i94res and i94cit codes into country names
@@ -67,214 +302,196 @@ def load_source_data(spark, input_data, output_data):
     #    and state_of_entry_full into capital letters
     # 5. Translate i94mode code into border cross method text name
     # 6. Translate i94visa code into type of visa text name
-    # 7. Convert dates from SAS format (with base - 1960-01-01)
+    # 7. Convert dates from SAS format (with base - 1960-01-01) - once per row in the subquery
     # 8. Add year, month and day fields for parquet partitions
+    # Port dictionary table is tiny, so we broadcast it to avoid shuffling the i94 fact data.
+    # Rows with unknown codes are dropped (as the inner joins with dictionary tables did before)
     i94_full_source_table = spark.sql('''
-        SELECT CAST(cicid AS LONG) id, UPPER(c1.country_name) country_of_residence, UPPER(c2.country_name) country_of_citizenship,
-                UPPER(p.port_location) city_of_entry, UPPER(p.state) state_of_entry_code, UPPER(s.state) state_of_entry_full, 
-                m.border_cross_method border_cross_method, v.visa_type type_of_visa,
+        SELECT /*+ BROADCAST(p) */
+                CAST(cicid AS LONG) id, UPPER(i.res_country_name) country_of_residence, UPPER(i.cit_country_name) country_of_citizenship,
+                UPPER(p.port_location) city_of_entry, UPPER(p.state) state_of_entry_code, UPPER(p.state_name) state_of_entry_full, 
+                i.border_cross_method border_cross_method, i.visa_type type_of_visa,
                 i.visatype class_of_admission, i.gender gender, CAST(i.i94bir AS LONG) age,
-                date_add(to_date('1960-01-01'), CAST(arrdate AS LONG)) arr_date, date_add(to_date('1960-01-01'), CAST(depdate AS LONG)) dep_date,
-                YEAR(CAST(date_add(to_date('1960-01-01'), CAST(arrdate AS LONG)) AS DATE)) year,
-                MONTH(CAST(date_add(to_date('1960-01-01'), CAST(arrdate AS LONG)) AS DATE)) month,
-                DAY(CAST(date_add(to_date('1960-01-01'), CAST(arrdate AS LONG)) AS DATE)) day
-        FROM i94_table i
-        JOIN country_table c1
-        ON CAST(i.i94res AS LONG) = c1.code
-        JOIN country_table c2
-        ON CAST(i.i94cit AS LONG) = c2.code
+                i.arr_date arr_date, i.dep_date dep_date,
+                YEAR(i.arr_date) year, MONTH(i.arr_date) month, DAY(i.arr_date) day
+        FROM (
+            SELECT *, date_add(to_date('1960-01-01'), CAST(arrdate AS LONG)) arr_date,
+                    date_add(to_date('1960-01-01'), CAST(depdate AS LONG)) dep_date
+            FROM i94_table
+        ) i
         JOIN port_table p
         ON i.i94port = p.code
-        JOIN mode_table m
-        ON CAST(i94mode AS LONG) = m.code
-        JOIN visa_table v
-        ON CAST(i94visa AS LONG) = v.code
-        JOIN states_df s
-        ON p.state = s.code
+        WHERE (i.res_country_name IS NOT NULL) AND (i.cit_country_name IS NOT NULL) AND
+                (i.border_cross_method IS NOT NULL) AND (i.visa_type IS NOT NULL) AND (p.state_name IS NOT NULL)
     ''')
     i94_full_source_table.createOrReplaceTempView("i94_source_table")
-    print(f'{i94_full_source_table.count():,d} records were successfully processed into i94_source_table table.')
+    if VERBOSE:
+        logger.info(f'{i94_full_source_table.count():,d} records were successfully processed into i94_source_table table.')
     
     # For cities_pop_source_table we perform following tasks:
-    # 1. Set correct data types for the fields 
-    # 2. Convert city, state and state_code into capital letters
+    # 1. Convert city, state and state_code into capital letters
+    # (correct data types for the fields are already set by CITIES_POP_SCHEMA)
     cities_pop_source_table = spark.sql('''
-        SELECT UPPER(city) city, UPPER(state) state, CAST(median_age AS DOUBLE) median_age,
-                CAST(male_population AS LONG) male_population, CAST(female_population AS LONG) female_population,
-                CAST(total_population AS LONG) total_population, CAST(number_of_veterans AS LONG) number_of_veterans,
-                CAST(foreign_born AS LONG) foreign_born, CAST(avg_household_size AS DOUBLE) avg_household_size,
-                UPPER(state_code) state_code, race, CAST(count AS LONG) count
+        SELECT UPPER(city) city, UPPER(state) state, median_age,
+                male_population, female_population,
+                total_population, number_of_veterans,
+                foreign_born, avg_household_size,
+                UPPER(state_code) state_code, race, count
         FROM cities_pop_table c
     ''')
     cities_pop_source_table.createOrReplaceTempView("cities_pop_source_table")
-    print(f'{cities_pop_source_table.count():,d} records were successfully processed into cities_pop_source_table table.')
+    if VERBOSE:
+        logger.info(f'{cities_pop_source_table.count():,d} records were successfully processed into cities_pop_source_table table.')
 
 
     # For airports_source_table we perform following tasks:
-    # 1. Set correct data types for the fields
+    # 1. Set correct data types for the coordinates fields
     # 2. Extract state abbreviation from iso_region field
     # 3. Split coordinates field into lat and lon fields
     # 4. Convert municipality and iso_region into capital letters
     # 5. Drop closed airports and those that are not in the US
     airports_source_table = spark.sql('''
-        SELECT type, name, CAST(elevation_ft AS LONG) elevation_ft, UPPER(SPLIT(iso_region, '-')[1]) iso_region,
+        SELECT type, name, elevation_ft, UPPER(SPLIT(iso_region, '-')[1]) iso_region,
                 UPPER(municipality) municipality, gps_code, CAST(SPLIT(coordinates,',')[0] AS DOUBLE) lon, CAST(SPLIT(coordinates,',')[1] AS DOUBLE) lat
         FROM airports_table a
         WHERE iso_country = 'US' AND type != 'closed'
     ''')
     airports_source_table.createOrReplaceTempView("airports_source_table")
-    print(f'{airports_source_table.count():,d} records were successfully processed into airports_source_table table.')
+    if VERBOSE:
+        logger.info(f'{airports_source_table.count():,d} records were successfully processed into airports_source_table table.')
 
     # For weather_source_table we perform following tasks:
-    # 1. Set correct data types for the fields
+    # 1. Set correct data types for the coordinates fields
     # 2. Convert country and city into capital letters 
     # 3. Drop cities that are not in the US
-    # 4. Drop records before 1960
+    # 4. Drop records before 1960 (plain comparison on dt, so the filter can be pushed down to the reader)
     # 5. Convert longitude and latitude from string representation (like 39.38N - 89.48W) into real numbers.
     #    For simplicity of transformation we assume that all cities in dataset will have north latitude (> 0) 
     #    and west longitude (< 0) since we've dropped all cities from outside of the U.S.
     # 6. Add year, month and day fields for parquet partitions
     weather_source_table = spark.sql('''
-        SELECT CAST(dt AS DATE) dt, YEAR(CAST(dt AS DATE)) year, MONTH(CAST(dt AS DATE)) month, DAY(CAST(dt AS DATE)) day, CAST(AverageTemperature AS DOUBLE) avg_temperature,
-        UPPER(city) city, UPPER(country) country, CAST(SUBSTRING(longitude,1,LENGTH(longitude)-1) AS DOUBLE)*-1 lon, CAST(SUBSTRING(latitude,1,LENGTH(latitude)-1) AS DOUBLE) lat
-        FROM weather_table w
-        WHERE country = 'United States' AND YEAR(CAST(dt AS DATE)) >= 1960
+        SELECT dt, YEAR(dt) year, MONTH(dt) month, DAY(dt) day, avg_temperature,
+        UPPER(city) city, UPPER(country) country, CAST(lon_s AS DOUBLE)*-1 lon, CAST(lat_s AS DOUBLE) lat
+        FROM (
+            SELECT dt, AverageTemperature avg_temperature, city, country,
+                    SUBSTRING(longitude,1,LENGTH(longitude)-1) lon_s, SUBSTRING(latitude,1,LENGTH(latitude)-1) lat_s
+            FROM weather_table
+            WHERE country = 'United States' AND dt >= DATE '1960-01-01'
+        ) w
     ''')
     weather_source_table.createOrReplaceTempView("weather_source_table")
-    print(f'{weather_source_table.count():,d} records were successfully processed into weather_source_table table.')
+    if VERBOSE:
+        logger.info(f'{weather_source_table.count():,d} records were successfully processed into weather_source_table table.')
 
     #write source tables into the data lake using parquet format
-    print()
-    print('Writing raw source tables into the data lake...')
-    i94_full_source_table.write.partitionBy('year', 'month').mode('overwrite').\
-                    parquet(output_data + 'source/i94/i94_records.parquet')
-    print('i94_records.parquet was successfully saved in the data lake.')
+    #(source tables are passed to the next step in memory, so we save them only for debugging purposes)
+    if checkpoint:
+        logger.info('Writing raw source tables into the data lake...')
+        write_parquet(i94_full_source_table, output_data + 'source/i94/i94_records.parquet',
+                      ['year', 'month'], ['year', 'month', 'day'])
+        logger.info('i94_records.parquet was successfully saved in the data lake.')
 
-    cities_pop_source_table.write.partitionBy('state_code').mode('overwrite').\
-                    parquet(output_data + 'source/demographic/demographic.parquet')
-    print('demographic.parquet was successfully saved in the data lake.')
+        write_parquet(cities_pop_source_table, output_data + 'source/demographic/demographic.parquet', ['state_code'])
+        logger.info('demographic.parquet was successfully saved in the data lake.')
 
-    weather_source_table.write.partitionBy('year', 'month').mode('overwrite').\
-                    parquet(output_data + 'source/weather/weather.parquet')
-    print('weather.parquet was successfully saved in the data lake.')
+        write_parquet(weather_source_table, output_data + 'source/weather/weather.parquet', ['year', 'month'])
+        logger.info('weather.parquet was successfully saved in the data lake.')
 
-    airports_source_table.write.partitionBy('iso_region').mode('overwrite').\
-                    parquet(output_data + 'source/airports/airports.parquet')
-    print('airports.parquet was successfully saved in the data lake.')
+        write_parquet(airports_source_table, output_data + 'source/airports/airports.parquet', ['iso_region'])
+        logger.info('airports.parquet was successfully saved in the data lake.')
 
-    print('Step 1 - Data extraction from external sources - successfully completed.')
-    print('')
+    logger.info('Step 1 - Data extraction from external sources - successfully completed.')
+    return [i94_full_source_table, cities_pop_source_table, weather_source_table, airports_source_table]
 
     
-def process_source_data(spark, input_data, output_data):
+def process_source_data(spark, input_data, output_data, source_tables=None, checkpoint=False):
     """
-    - Load source data tables from S3 data lake
+    - Load source data tables from S3 data lake (if they were not passed from the previous step)
     - Drop rows with missing values critical for the consistency
     - Further process source data (transform table shapes, data fields etc.)
     - Quality checks: eliminating duplicate rows and rows with incorrect combination of field values
-    - Save preprocessed source tables to the S3 data lake (in parquet format)
+    - Save preprocessed source tables to the S3 data lake (in parquet format), if checkpoint is set
+    
+    Return:
+    - List of preprocessed source tables (i94, demographic, weather and airports) persisted in memory
+      for the next step of pipeline
     """
-    print('Step 2 - Data cleaning, aligning and source quality checks - started.')
-    print()
+    logger.info('Step 2 - Data cleaning, aligning and source quality checks - started.')
     
-    # Read source tables from the data lake
-    print('Loading source tables from the data lake...')
-    i94_full_source_table = spark.read.parquet(output_data + 'source/i94/i94_records.parquet')
+    # Read source tables from the data lake (if they were not passed from the previous step)
+    if source_tables is None:
+        logger.info('Loading source tables from the data lake...')
+        source_tables = [spark.read.parquet(output_data + 'source/i94/i94_records.parquet'),
+                         spark.read.parquet(output_data + 'source/demographic/demographic.parquet'),
+                         spark.read.parquet(output_data + 'source/weather/weather.parquet'),
+                         spark.read.parquet(output_data + 'source/airports/airports.parquet')]
+    i94_full_source_table, cities_pop_source_table, weather_source_table, airports_source_table = source_tables
     i94_full_source_table.createOrReplaceTempView("i94_source_table")
-    i94_full_source_count = i94_full_source_table.count()
-    print(f'{i94_full_source_count:,d} records were successfully loaded from the data lake into i94_source_table table.')
-    cities_pop_source_table = spark.read.parquet(output_data + 'source/demographic/demographic.parquet')
+    if VERBOSE:
+        i94_full_source_count = i94_full_source_table.count()
+        logger.info(f'{i94_full_source_count:,d} records were successfully loaded into i94_source_table table.')
     cities_pop_source_table.createOrReplaceTempView("cities_pop_source_table")
-    cities_pop_source_count = cities_pop_source_table.count()
-    print(f'{cities_pop_source_count:,d} records were successfully loaded from the data lake into cities_pop_source_table table.')
-    weather_source_table = spark.read.parquet(output_data + 'source/weather/weather.parquet')
+    if VERBOSE:
+        cities_pop_source_count = cities_pop_source_table.count()
+        logger.info(f'{cities_pop_source_count:,d} records were successfully loaded into cities_pop_source_table table.')
     weather_source_table.createOrReplaceTempView("weather_source_table")
-    weather_source_count = weather_source_table.count()
-    print(f'{weather_source_count:,d} records were successfully loaded from the data lake into weather_source_table table.')
-    airports_source_table = spark.read.parquet(output_data + 'source/airports/airports.parquet')
+    if VERBOSE:
+        weather_source_count = weather_source_table.count()
+        logger.info(f'{weather_source_count:,d} records were successfully loaded into weather_source_table table.')
     airports_source_table.createOrReplaceTempView("airports_source_table")
-    airports_source_count = airports_source_table.count()
-    print(f'{airports_source_count:,d} records were successfully loaded from the data lake into airports_source_table table.')
+    if VERBOSE:
+        airports_source_count = airports_source_table.count()
+        logger.info(f'{airports_source_count:,d} records were successfully loaded into airports_source_table table.')
 
     # Drop rows with missing values critical for the consistency
     # and further process source data (transform table shapes, data fields etc.).
-    print()
-    print('Cleaning and transforming source tables...')
+    logger.info('Cleaning and transforming source tables...')
     
     # For i94_source_table we perform following tasks:
     # 1. drop rows with duplicate id field
     # 2. drop rows with missing values in id, state_of_entry_code, city_of_entry, arr_date
     # 3. drop rows with dep_date < arr_date
+    # Duplicates are dropped by the id key only instead of comparing all fields of the wide table
     i94_full_source_table = spark.sql('''
-        SELECT DISTINCT *
+        SELECT *
         FROM i94_source_table i
         WHERE (id IS NOT NULL) AND (state_of_entry_code IS NOT NULL) AND
                 (city_of_entry IS NOT NULL) AND (arr_date IS NOT NULL) AND
                 (dep_date IS NULL OR dep_date >= arr_date)
-    ''')
+    ''').dropDuplicates(['id'])
     i94_full_source_table.createOrReplaceTempView("i94_source_table")
-    i94_full_processed_count = i94_full_source_table.count()
-    print(f'i94_source_table was successfully preprocessed.')
-    print(f'{(i94_full_source_count - i94_full_processed_count):,d} records were dropped from the table.')
-    print(f'Total number of rows in preprocessed i94_source_table - {i94_full_processed_count:,d}.')
+    logger.info('i94_source_table was successfully preprocessed.')
+    if VERBOSE:
+        i94_full_processed_count = i94_full_source_table.count()
+        logger.info(f'{(i94_full_source_count - i94_full_processed_count):,d} records were dropped from the table.')
+        logger.info(f'Total number of rows in preprocessed i94_source_table - {i94_full_processed_count:,d}.')
     
     # For cities_pop_source_table we perform following tasks:
     # 1. drop rows with missing values in city and state_code
     # 2. build pivot columns for different races in given city - state
     # 3. drop rows with duplicate combination of city and state_code fields
-    # Step 1
-    cities_pop_source_table = spark.sql('''
-        SELECT *
-        FROM cities_pop_source_table c
-        WHERE (city IS NOT NULL) AND (state_code IS NOT NULL)
-    ''')
-    cities_pop_source_table.createOrReplaceTempView("cities_pop_source_table")
-    # Steps 2 and 3
+    # All steps are performed in a single aggregation pass over the table
+    # (instead of joining it with itself for every race)
     cities_pop_source_table = spark.sql('''
-        SELECT DISTINCT c.city city, c.state state, c.state_code state_code, c.median_age median_age, 
-                        c.male_population male_population, c.female_population female_population,
-                        c.total_population total_population, c.number_of_veterans number_of_veterans,
-                        c.foreign_born foreign_born, c.avg_household_size avg_household_size,
-                        c1.american_indian_and_alaska_native american_indian_and_alaska_native,
-                        c2.asian asian, c3.white white, c4.hispanic_or_latino hispanic_or_latino,
-                        c5.black_or_african_american black_or_african_american
+        SELECT c.city city, c.state state, c.state_code state_code, FIRST(c.median_age) median_age,
+                FIRST(c.male_population) male_population, FIRST(c.female_population) female_population,
+                FIRST(c.total_population) total_population, FIRST(c.number_of_veterans) number_of_veterans,
+                FIRST(c.foreign_born) foreign_born, FIRST(c.avg_household_size) avg_household_size,
+                MAX(CASE WHEN c.race = "American Indian and Alaska Native" THEN c.count END) american_indian_and_alaska_native,
+                MAX(CASE WHEN c.race = "Asian" THEN c.count END) asian,
+                MAX(CASE WHEN c.race = "White" THEN c.count END) white,
+                MAX(CASE WHEN c.race = "Hispanic or Latino" THEN c.count END) hispanic_or_latino,
+                MAX(CASE WHEN c.race = "Black or African-American" THEN c.count END) black_or_african_american
         FROM cities_pop_source_table c
-        LEFT JOIN (
-            SELECT city, state, count as american_indian_and_alaska_native
-            FROM cities_pop_source_table
-            WHERE race = "American Indian and Alaska Native"
-        ) c1
-        ON c.city = c1.city AND c.state = c1.state
-        LEFT JOIN (
-            SELECT city, state, count as asian
-            FROM cities_pop_source_table
-            WHERE race = "Asian"
-        ) c2
-        ON c.city = c2.city AND c.state = c2.state
-        LEFT JOIN (
-            SELECT city, state, count as white
-            FROM cities_pop_source_table
-            WHERE race = "White"
-        ) c3
-        ON c.city = c3.city AND c.state = c3.state
-        LEFT JOIN (
-            SELECT city, state, count as hispanic_or_latino
-            FROM cities_pop_source_table
-            WHERE race = "Hispanic or Latino"
-        ) c4
-        ON c.city = c4.city AND c.state = c4.state
-        LEFT JOIN (
-            SELECT city, state, count as black_or_african_american
-            FROM cities_pop_source_table
-            WHERE race = "Black or African-American"
-        ) c5
-        ON c.city = c5.city AND c.state = c5.state
+        WHERE (c.city IS NOT NULL) AND (c.state_code IS NOT NULL)
+        GROUP BY c.city, c.state, c.state_code
     ''')
     cities_pop_source_table.createOrReplaceTempView("cities_pop_source_table")
-    cities_pop_processed_count = cities_pop_source_table.count()
-    print(f'cities_pop_source_table was successfully preprocessed.')
-    print(f'{(cities_pop_source_count - cities_pop_processed_count):,d} records were dropped from the table.')
-    print(f'Total number of rows in preprocessed cities_pop_source_table - {cities_pop_processed_count:,d}.')
+    logger.info('cities_pop_source_table was successfully preprocessed.')
+    if VERBOSE:
+        cities_pop_processed_count = cities_pop_source_table.count()
+        logger.info(f'{(cities_pop_source_count - cities_pop_processed_count):,d} records were dropped from the table.')
+        logger.info(f'Total number of rows in preprocessed cities_pop_source_table - {cities_pop_processed_count:,d}.')
 
     # For airports_source_table we perform following tasks:
     # 1. drop rows with missing values in iso_region, municipality, lat and lon
@@ -288,14 +505,15 @@ def process_source_data(spark, input_data, output_data):
         (lat is NOT NULL) AND (lon is NOT NULL)
     ''')
     airports_source_table.createOrReplaceTempView("airports_source_table")
-    airports_processed_count = airports_source_table.count()
-    print(f'airports_source_table was successfully preprocessed.')
-    print(f'{(airports_source_count - airports_processed_count):,d} records were dropped from the table.')
-    print(f'Total number of rows in preprocessed airports_source_table - {airports_processed_count:,d}.')
+    logger.info('airports_source_table was successfully preprocessed.')
+    if VERBOSE:
+        airports_processed_count = airports_source_table.count()
+        logger.info(f'{(airports_source_count - airports_processed_count):,d} records were dropped from the table.')
+        logger.info(f'Total number of rows in preprocessed airports_source_table - {airports_processed_count:,d}.')
 
     # For weather_source_table we perform following tasks:
     # 1. drop rows with missing values in dt, avg_temperature, city, lat and lon
-    # 2. drop duplicate rows
+    # 2. drop duplicate rows (by dt, city, lat and lon natural key)
     # 3. join this table with airports_source_table using distance estimate 
     #    from city coordinates (lat-lon) to airport coordinates (lat-lon) 
     #    and evaluate state code for every city
@@ -303,11 +521,11 @@ def process_source_data(spark, input_data, output_data):
     # as we cannot use them unambiguously in the future analysis
     # Steps 1 and 2
     weather_source_table = spark.sql('''
-        SELECT DISTINCT *
+        SELECT *
         FROM weather_source_table w
         WHERE (avg_temperature IS NOT NULL) AND (dt IS NOT NULL) AND
                 (city IS NOT NULL) AND (lat IS NOT NULL) AND (lon IS NOT NULL)
-    ''')
+    ''').dropDuplicates(['dt', 'city', 'lat', 'lon'])
     weather_source_table.createOrReplaceTempView("weather_source_table")    
     # Step 3
     tmp_loc_table = spark.sql('''
@@ -316,11 +534,14 @@ def process_source_data(spark, input_data, output_data):
     ''')
     tmp_loc_table.createOrReplaceTempView("tmp_loc_table")
     DISTANCE_THRESHOLD = 1 # Distance threshold constant. Might be adjusted based on the number of dropped records in final table
+    # Cities are joined with the (small, broadcasted) airports table by name and then filtered
+    # by the squared distance, so Spark uses hash join instead of nested loop over all pairs
     tmp_loc_table = spark.sql(f'''
-        SELECT DISTINCT w1.city city, a.iso_region state, w1.lat lat, w1.lon lon
+        SELECT /*+ BROADCAST(a) */ DISTINCT w1.city city, a.iso_region state, w1.lat lat, w1.lon lon
         FROM tmp_loc_table w1
         JOIN airports_source_table a
-        ON SQRT((w1.lat-a.lat)*(w1.lat-a.lat)+(w1.lon-a.lon)*(w1.lon-a.lon)) < {DISTANCE_THRESHOLD} AND w1.city = a.municipality
+        ON w1.city = a.municipality
+        WHERE (w1.lat-a.lat)*(w1.lat-a.lat)+(w1.lon-a.lon)*(w1.lon-a.lon) < {DISTANCE_THRESHOLD * DISTANCE_THRESHOLD}
     ''')
     tmp_loc_table.createOrReplaceTempView("tmp_loc_table")
     weather_source_table = spark.sql('''
@@ -332,33 +553,37 @@ def process_source_data(spark, input_data, output_data):
         GROUP BY w.dt, w.year, w.month, w.day, w.city, w1.state, w.lat, w.lon    
     ''')
     weather_source_table.createOrReplaceTempView("weather_source_table")
-    weather_processed_count = weather_source_table.count()
-    print(f'weather_source_table was successfully preprocessed.')
-    print(f'{(weather_source_count - weather_processed_count):,d} records were dropped from the table.')
-    print(f'Total number of rows in preprocessed weather_source_table - {weather_processed_count:,d}.')
+    logger.info('weather_source_table was successfully preprocessed.')
+    if VERBOSE:
+        weather_processed_count = weather_source_table.count()
+        logger.info(f'{(weather_source_count - weather_processed_count):,d} records were dropped from the table.')
+        logger.info(f'Total number of rows in preprocessed weather_source_table - {weather_processed_count:,d}.')
+
+    # Preprocessed tables are scanned several times while building the data model,
+    # so we keep them in memory and pass them to the next step
+    clean_tables = [table.persist(StorageLevel.MEMORY_AND_DISK) for table in
+                    [i94_full_source_table, cities_pop_source_table, weather_source_table, airports_source_table]]
 
     #write prepared source tables into the data lake using parquet format
-    print()
-    print('Writing preprocessed source tables into the data lake...')
+    #(preprocessed tables are passed to the next step in memory, so we save them only for debugging purposes)
+    if checkpoint:
+        logger.info('Writing preprocessed source tables into the data lake...')
 
-    i94_full_source_table.write.partitionBy('year', 'month').mode('overwrite').\
-                    parquet(output_data + 'preprocessed/i94/i94_records.parquet')
-    print('i94_records.parquet was successfully saved in the data lake.')
+        write_parquet(i94_full_source_table, output_data + 'preprocessed/i94/i94_records.parquet',
+                      ['year', 'month'], ['year', 'month', 'day'])
+        logger.info('i94_records.parquet was successfully saved in the data lake.')
 
-    cities_pop_source_table.write.partitionBy('state_code').mode('overwrite').\
-                    parquet(output_data + 'preprocessed/demographic/demographic.parquet')
-    print('demographic.parquet was successfully saved in the data lake.')
+        write_parquet(cities_pop_source_table, output_data + 'preprocessed/demographic/demographic.parquet', ['state_code'])
+        logger.info('demographic.parquet was successfully saved in the data lake.')
 
-    weather_source_table.write.partitionBy('year', 'month').mode('overwrite').\
-                    parquet(output_data + 'preprocessed/weather/weather.parquet')
-    print('weather.parquet was successfully saved in the data lake.')
+        write_parquet(weather_source_table, output_data + 'preprocessed/weather/weather.parquet', ['year', 'month'])
+        logger.info('weather.parquet was successfully saved in the data lake.')
 
-    airports_source_table.write.partitionBy('iso_region').mode('overwrite').\
-                    parquet(output_data + 'preprocessed/airports/airports.parquet')
-    print('airports.parquet was successfully saved in the data lake.')
+        write_parquet(airports_source_table, output_data + 'preprocessed/airports/airports.parquet', ['iso_region'])
+        logger.info('airports.parquet was successfully saved in the data lake.')
 
-    print('Step 2 - Data cleaning, aligning and source quality checks - successfully completed.')
-    print('')
+    logger.info('Step 2 - Data cleaning, aligning and source quality checks - successfully completed.')
+    return clean_tables
 
 
 def check_model_quality(spark, model_data):
@@ -371,85 +596,99 @@ def check_model_quality(spark, model_data):
     - True, if check have passed
     - False, otherwise
     """
-    print()
-    print('Final quality checks for the data model - started.')
-    print()
+    logger.info('Final quality checks for the data model - started.')
     
     fact_i94_history_table = model_data[0]
     dim_cities_table = model_data[1]
     dim_time_table = model_data[2]
     
-    if (fact_i94_history_table.count() == 0) or (dim_cities_table.count() == 0) or \
-        (dim_time_table.count() == 0):
+    # take(1) stops scanning as soon as the first record is found
+    if (not fact_i94_history_table.take(1)) or (not dim_cities_table.take(1)) or \
+        (not dim_time_table.take(1)):
         return False
     
     fact_i94_history_table.createOrReplaceTempView("fact_i94_history")
     dim_cities_table.createOrReplaceTempView("dim_cities")
     dim_time_table.createOrReplaceTempView("dim_time")
 
+    # Anti-join with (small, broadcasted) dim_time table - we need only the first missing date, if any
     check_query = spark.sql('''
-        SELECT f.arr_date, t.dt
+        SELECT f.arr_date
         FROM fact_i94_history f
-        LEFT JOIN dim_time t
-        ON (YEAR(f.arr_date) = YEAR(t.dt)) AND (MONTH(f.arr_date) = MONTH(t.dt))
-        WHERE t.dt IS NULL
+        WHERE NOT EXISTS (
+            SELECT /*+ BROADCAST(t) */ 1
+            FROM dim_time t
+            WHERE (f.year = t.year) AND (f.month = t.month)
+        )
+        LIMIT 1
     ''')
-    if check_query.count() > 0:
+    if check_query.take(1):
         return False
     
-    print('Final quality checks for the data model - successfully completed.')
-    print('')
+    logger.info('Final quality checks for the data model - successfully completed.')
     return True
 
 
-def build_data_model(spark, input_data, output_data):
+def build_data_model(spark, input_data, output_data, clean_tables=None):
     """
-    - Load preprocessed source data tables from S3 data lake
+    - Load preprocessed source data tables from S3 data lake (if they were not passed from the previous step)
     - Create fact table (fact_i94_history) and dimension tables (dim_time and dim_cities)
     - Perform quality checks on the data model
     - Save final fact and dimension tables to parquet files in the S3 data lake
     """
-    print('Step 3 - Forming the target data model and final quality checks - started.')
-    print()
-    # Read source tables from the data lake
-    print('Loading preprocessed source tables from the data lake...')
-    i94_full_source_table = spark.read.parquet(output_data + 'preprocessed/i94/i94_records.parquet')
+    logger.info('Step 3 - Forming the target data model and final quality checks - started.')
+    # Read preprocessed source tables from the data lake (if they were not passed from the previous step).
+    # Tables are scanned several times while building the model, so we keep them in memory
+    if clean_tables is None:
+        logger.info('Loading preprocessed source tables from the data lake...')
+        clean_tables = [spark.read.parquet(output_data + 'preprocessed/i94/i94_records.parquet'),
+                        spark.read.parquet(output_data + 'preprocessed/demographic/demographic.parquet'),
+                        spark.read.parquet(output_data + 'preprocessed/weather/weather.parquet'),
+                        spark.read.parquet(output_data + 'preprocessed/airports/airports.parquet')]
+        clean_tables = [table.persist(StorageLevel.MEMORY_AND_DISK) for table in clean_tables]
+    i94_full_source_table, cities_pop_source_table, weather_source_table, airports_source_table = clean_tables
     i94_full_source_table.createOrReplaceTempView("i94_clean_source_table")
-    print(f'{i94_full_source_table.count():,d} records were successfully loaded from the data lake into i94_clean_source_table table.')
-    cities_pop_source_table = spark.read.parquet(output_data + 'preprocessed/demographic/demographic.parquet')
+    if VERBOSE:
+        logger.info(f'{i94_full_source_table.count():,d} records were successfully loaded into i94_clean_source_table table.')
     cities_pop_source_table.createOrReplaceTempView("cities_pop_clean_source_table")
-    print(f'{cities_pop_source_table.count():,d} records were successfully loaded from the data lake into cities_pop_clean_source_table table.')
-    weather_source_table = spark.read.parquet(output_data + 'preprocessed/weather/weather.parquet')
+    if VERBOSE:
+        logger.info(f'{cities_pop_source_table.count():,d} records were successfully loaded into cities_pop_clean_source_table table.')
     weather_source_table.createOrReplaceTempView("weather_clean_source_table")
-    print(f'{weather_source_table.count():,d} records were successfully loaded from the data lake into weather_clean_source_table table.')
-    airports_source_table = spark.read.parquet(output_data + 'preprocessed/airports/airports.parquet')
+    if VERBOSE:
+        logger.info(f'{weather_source_table.count():,d} records were successfully loaded into weather_clean_source_table table.')
     airports_source_table.createOrReplaceTempView("airports_clean_source_table")
-    print(f'{airports_source_table.count():,d} records were successfully loaded from the data lake into airports_clean_source_table table.')
+    if VERBOSE:
+        logger.info(f'{airports_source_table.count():,d} records were successfully loaded into airports_clean_source_table table.')
 
     # Build dimension tables
-    print()
-    print('Building dimension tables...')
+    logger.info('Building dimension tables...')
     
     # For dim_time table we perform the following tasks:
     # 1. extract unique date values from arr_date and dep_date fields of i94_clean_source_table and 
     #    from dt field of weather_clean_source_table and make a union of them
     # 2. add separate fields for year, month, day, weekday and week parts of date
     dim_time_table = spark.sql('''
-        SELECT DISTINCT i1.arr_date dt, YEAR(i1.arr_date) year, MONTH(i1.arr_date) month, DAY(i1.arr_date) day,
-                        DAYOFWEEK(i1.arr_date) dow, WEEKOFYEAR(i1.arr_date) week
-        FROM i94_clean_source_table i1
-        UNION
-        SELECT DISTINCT i2.dep_date dt, YEAR(i2.dep_date) year, MONTH(i2.dep_date) month, DAY(i2.dep_date) day,
-                        DAYOFWEEK(i2.dep_date) dow, WEEKOFYEAR(i2.dep_date) week
-        FROM i94_clean_source_table i2
-        WHERE i2.dep_date IS NOT NULL
-        UNION
-        SELECT DISTINCT w.dt dt, YEAR(w.dt) year, MONTH(w.dt) month, DAY(w.dt) day,
-                        DAYOFWEEK(w.dt) dow, WEEKOFYEAR(w.dt) week
-        FROM weather_clean_source_table w
+        SELECT t.dt dt, YEAR(t.dt) year, MONTH(t.dt) month, DAY(t.dt) day,
+                DAYOFWEEK(t.dt) dow, WEEKOFYEAR(t.dt) week
+        FROM (
+            SELECT DISTINCT u.dt dt
+            FROM (
+                SELECT i1.arr_date dt
+                FROM i94_clean_source_table i1
+                UNION ALL
+                SELECT i2.dep_date dt
+                FROM i94_clean_source_table i2
+                WHERE i2.dep_date IS NOT NULL
+                UNION ALL
+                SELECT w.dt dt
+                FROM weather_clean_source_table w
+            ) u
+        ) t
     ''')
     dim_time_table.createOrReplaceTempView("dim_time")
-    print(f'Dimension table dim_time with {dim_time_table.count():,d} records was successfully created .')
+    logger.info('Dimension table dim_time was successfully created.')
+    if VERBOSE:
+        logger.info(f'Dimension table dim_time contains {dim_time_table.count():,d} records.')
 
     # For dim_cities table we perform following tasks:
     # 1. extract all attributes from cities_pop_clean_source_table
@@ -471,25 +710,26 @@ def build_data_model(spark, input_data, output_data):
     airports_pivot_table.createOrReplaceTempView("airports_pivot_table")
     # Step 3
     dim_cities_table = spark.sql('''
-        SELECT dc.*, a.number_of_airports number_of_airports
+        SELECT /*+ BROADCAST(a) */ dc.*, a.number_of_airports number_of_airports
         FROM dim_cities dc
         LEFT JOIN airports_pivot_table a
         ON (dc.city = a.municipality) AND (dc.state_code = a.iso_region)
     ''')
     dim_cities_table.createOrReplaceTempView("dim_cities")
-    print(f'Dimension table dim_cities with {dim_cities_table.count():,d} records was successfully created .')
+    logger.info('Dimension table dim_cities was successfully created.')
+    if VERBOSE:
+        logger.info(f'Dimension table dim_cities contains {dim_cities_table.count():,d} records.')
 
     # Build fact table
-    print()
-    print('Building fact table...')
+    logger.info('Building fact table...')
     # For fact_i94_history table we perform following tasks:
     # 1. extract following attributes from i94_clean_source_table:
     #    id, country_of_residence, country_of_citizenship, city_of_entry, state_of_entry_code, border_cross_method,
     #    type_of_visa, class_of_admission, gender, age, arr_date, dep_date
     # 2. add fields for year, month and day parts of the arrival_date
     # 3. add avg_temperature field in resulting fact_i94_history table 
-    #    by joining city_of_entry & state_of_entry_code & YEAR(arr_date) & MONTH(arr_date) composite key 
-    #    with city & state & YEAR(dt) & MONTH(dt) omposite key
+    #    by joining city_of_entry & state_of_entry_code & year & month composite key 
+    #    with city & state & year & month composite key (year and month are partition columns of both tables)
     # Steps 1 and 2
     fact_i94_history_table = spark.sql('''
         SELECT i.id id, i.country_of_residence country_of_residence, i.country_of_citizenship country_of_citizenship,
@@ -501,49 +741,90 @@ def build_data_model(spark, input_data, output_data):
     ''')
     fact_i94_history_table.createOrReplaceTempView("fact_i94_history")
     # Step 3
+    # Weather data is aggregated to the monthly grain of the join before joining it with the fact table
+    # (monthly weather table for the U.S. cities is small enough to be broadcasted to the fact table partitions)
+    weather_monthly_table = spark.sql('''
+        SELECT w.year year, w.month month, w.city city, w.state state, AVG(w.avg_temperature) avg_temperature
+        FROM weather_clean_source_table w
+        GROUP BY w.year, w.month, w.city, w.state
+    ''')
+    weather_monthly_table.createOrReplaceTempView("weather_monthly_table")
     fact_i94_history_table = spark.sql('''
-        SELECT f.*, w.avg_temperature avg_temperature
+        SELECT /*+ BROADCAST(w) */ f.*, w.avg_temperature avg_temperature
         FROM fact_i94_history f
-        LEFT JOIN weather_clean_source_table w
-        ON (YEAR(f.arr_date) = YEAR(w.dt)) AND (MONTH(f.arr_date) = MONTH(w.dt)) AND
+        LEFT JOIN weather_monthly_table w
+        ON (f.year = w.year) AND (f.month = w.month) AND
             (f.city_of_entry = w.city) AND (f.state_of_entry_code = w.state)
     ''')    
     fact_i94_history_table.createOrReplaceTempView("fact_i94_history")
-    print(f'Fact table fact_i94_history with {fact_i94_history_table.count():,d} records was successfully created .')
-    print()
+    logger.info('Fact table fact_i94_history was successfully created.')
+    if VERBOSE:
+        logger.info(f'Fact table fact_i94_history contains {fact_i94_history_table.count():,d} records.')
 
     model_data = [fact_i94_history_table, dim_cities_table, dim_time_table]
     check_res = check_model_quality(spark, model_data)
     if check_res:
-        print('Quality checks on the data model have successfully passed.')
+        logger.info('Quality checks on the data model have successfully passed.')
     else:
-        print('ERROR! Quality checks on the data model have failed!!!')
+        logger.error('Quality checks on the data model have failed!!!')
+        for table in clean_tables:
+            table.unpersist()
         return
 
     #write prepared fact and dimension tables into the data lake using parquet format
-    print()
-    print('Writing preprocessed fact and dimension tables into the data lake...')
-
-    fact_i94_history_table.write.partitionBy('year', 'month').mode('overwrite').\
-                    parquet(output_data + 'analytics/fact_i94_history/fact_i94_history.parquet')
-    print('fact_i94_history.parquet was successfully saved in the data lake.')
-    dim_cities_table.write.partitionBy('state_code').mode('overwrite').\
-                    parquet(output_data + 'analytics/dim_cities/dim_cities.parquet')
-    print('dim_cities.parquet was successfully saved in the data lake.')
-    dim_time_table.write.partitionBy('year', 'month').mode('overwrite').\
-                    parquet(output_data + 'analytics/dim_time/dim_time.parquet')
-    print('dim_time.parquet was successfully saved in the data lake.')
-    print('')
-
-    print('Step 3 - Forming the target data model and final quality checks - successfully completed.')
-    print('')
+    #(only columns of the data model are written, in the order of the data dictionary)
+    logger.info('Writing preprocessed fact and dimension tables into the data lake...')
+
+    dim_cities_table = dim_cities_table.select('city', 'state', 'median_age', 'male_population', 'female_population',
+                                               'total_population', 'number_of_veterans', 'foreign_born',
+                                               'avg_household_size', 'american_indian_and_alaska_native', 'asian',
+                                               'white', 'hispanic_or_latino', 'black_or_african_american',
+                                               'state_code', 'number_of_airports')
+    dim_time_table = dim_time_table.select('dt', 'year', 'month', 'day', 'dow', 'week')
+
+    write_parquet(fact_i94_history_table, output_data + 'analytics/fact_i94_history/fact_i94_history.parquet',
+                  ['year', 'month'], ['year', 'month', 'day'], dynamic_overwrite=True)
+    logger.info('fact_i94_history.parquet was successfully saved in the data lake.')
+    # Dimension tables are independent of each other, so they are written concurrently.
+    # Every write runs in its own scheduler pool, so the FAIR scheduler interleaves stages of both jobs
+    # (jobs of the same pool would still run in FIFO order)
+    def write_dim_parquet(pool, *args, **kwargs):
+        spark.sparkContext.setLocalProperty('spark.scheduler.pool', pool)
+        write_parquet(*args, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        dim_writes = [executor.submit(write_dim_parquet, 'dim_cities', dim_cities_table,
+                                      output_data + 'analytics/dim_cities/dim_cities.parquet', ['state_code'],
+                                      block_size=DIM_PARQUET_BLOCK_SIZE, num_partitions=DIM_WRITE_PARTITIONS),
+                      executor.submit(write_dim_parquet, 'dim_time', dim_time_table,
+                                      output_data + 'analytics/dim_time/dim_time.parquet', ['year', 'month'],
+                                      block_size=DIM_PARQUET_BLOCK_SIZE, num_partitions=DIM_WRITE_PARTITIONS,
+                                      dynamic_overwrite=True)]
+        for dim_write in dim_writes:
+            dim_write.result()
+    logger.info('dim_cities.parquet and dim_time.parquet were successfully saved in the data lake.')
+
+    for table in clean_tables:
+        table.unpersist()
+
+    logger.info('Step 3 - Forming the target data model and final quality checks - successfully completed.')
 
 
 def main():
     """
+    - Parses command line arguments (--checkpoint saves intermediate source tables of steps 1 and 2 to the data lake,
+      --start-step resumes the pipeline from these tables)
     - Creates Spark sessions
     - Executes all steps of the ETL pipelie
     """
+    parser = argparse.ArgumentParser(description='ETL pipeline for the US immigration data analysis')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='save raw and preprocessed source tables into the data lake after steps 1 and 2')
+    parser.add_argument('--start-step', type=int, choices=[1, 2, 3], default=1,
+                        help='resume the pipeline from given step using tables saved by a previous run with --checkpoint')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s - %(message)s')
+
     # State your input paths for source datasets
     input_data = {
         "i_94_immig": "../../data/18-83510-I94-Data-2016/i94_apr16_sub.sas7bdat",
@@ -554,23 +835,82 @@ def main():
     }
     # State your output s3 bucket for source data and processed fact and dimension tables  
     output_data = ""
+    # State your local directory for parquet files converted from the source datasets
+    staging_data = "staging/"
     
-    print('Starting or connecting to Spark...')
+    # Raw sources are read only by step 1, so they are not converted (and not required) when resuming
+    if args.start_step <= 1:
+        os.makedirs(staging_data, exist_ok=True)
+        # Convert i94 immigration SAS data into parquet staging file
+        # (only once per version of the source file, subsequent runs reuse the parquet file)
+        i94_parquet_path = staging_path(staging_data, 'i_94_immig', input_data['i_94_immig'])
+        if not os.path.exists(i94_parquet_path):
+            logger.info('Converting i94 immigration dataset from SAS format into parquet...')
+            sas_to_parquet(input_data['i_94_immig'], i94_parquet_path)
+            remove_stale_staging(staging_data, 'i_94_immig', i94_parquet_path)
+            logger.info('i94 immigration dataset was successfully converted.')
+        input_data['i_94_immig'] = i94_parquet_path
+        # Convert global temperatures CSV data into parquet staging file
+        # (only once per version of the source file, subsequent runs reuse the parquet file)
+        weather_parquet_path = staging_path(staging_data, 'temperature', input_data['temperature'])
+        if not os.path.exists(weather_parquet_path):
+            logger.info('Converting global temperatures by cities dataset from CSV format into parquet...')
+            csv_to_parquet(input_data['temperature'], weather_parquet_path, WEATHER_SCHEMA)
+            remove_stale_staging(staging_data, 'temperature', weather_parquet_path)
+            logger.info('Global temperatures by cities dataset was successfully converted.')
+        input_data['temperature'] = weather_parquet_path
+
+    logger.info('Starting or connecting to Spark...')
     spark = SparkSession.builder.\
-                config("spark.jars.repositories", "https://repos.spark-packages.org/").\
-                config("spark.jars.packages", "saurfang:spark-sas7bdat:2.0.0-s_2.11").\
+                config("spark.scheduler.mode", "FAIR").\
+                config("spark.ui.showConsoleProgress", "false").\
+                config("spark.sql.autoBroadcastJoinThreshold", "256MB").\
+                config("spark.sql.execution.arrow.pyspark.enabled", "true").\
+                config("spark.sql.execution.arrow.maxRecordsPerBatch", "20000").\
+                config("spark.sql.csv.parser.columnPruning.enabled", "true").\
+                config("spark.sql.files.maxRecordsPerFile", "2000000").\
+                config("spark.sql.maxConcurrentOutputFileWriters", "32").\
+                config("spark.sql.parquet.compression.codec", "zstd").\
+                config("spark.sql.inMemoryColumnarStorage.compressed", "true").\
+                config("spark.sql.inMemoryColumnarStorage.batchSize", "10000").\
+                config("spark.memory.fraction", "0.8").\
+                config("spark.memory.storageFraction", "0.5").\
+                config("spark.memory.offHeap.enabled", "true").\
+                config("spark.memory.offHeap.size", "4g").\
+                config("spark.serializer", "org.apache.spark.serializer.KryoSerializer").\
+                config("spark.kryo.registrationRequired", "false").\
+                config("spark.kryo.unsafe", "true").\
+                config("spark.kryoserializer.buffer", "1m").\
+                config("spark.kryoserializer.buffer.max", "128m").\
+                config("spark.shuffle.file.buffer", "1m").\
+                config("spark.shuffle.unsafe.file.output.buffer", "1m").\
+                config("spark.shuffle.spill.diskWriteBufferSize", "4m").\
+                config("spark.unsafe.sorter.spill.reader.buffer.size", "1m").\
+                config("spark.shuffle.unsafe.fastMergeEnabled", "true").\
+                config("spark.sql.adaptive.enabled", "true").\
+                config("spark.sql.adaptive.skewJoin.enabled", "true").\
+                config("spark.sql.adaptive.coalescePartitions.enabled", "true").\
+                config("spark.sql.adaptive.localShuffleReader.enabled", "true").\
+                config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128MB").\
                 enableHiveSupport().getOrCreate()
-    print('Spark session established successfully.')
+    # Size shuffles to the cluster instead of the default 200 partitions
+    # (AQE coalesces small post-shuffle partitions further)
+    spark.conf.set("spark.sql.shuffle.partitions", max(8, spark.sparkContext.defaultParallelism * 2))
+    logger.info('Spark session established successfully.')
     
     # Execute all stages of the ETL
+    # (skipped steps are replaced by reading their tables from the data lake in the next step)
+    source_tables = clean_tables = None
     # Step 1. Data extraction from external sources
-    load_source_data(spark, input_data, output_data)
+    if args.start_step <= 1:
+        source_tables = load_source_data(spark, input_data, output_data, args.checkpoint)
     
     #Step 2. Data cleaning, aligning and source quality checks
-    process_source_data(spark, input_data, output_data)
+    if args.start_step <= 2:
+        clean_tables = process_source_data(spark, input_data, output_data, source_tables, args.checkpoint)
 
     #Step 3. Forming the target data model and final quality checks
-    build_data_model(spark, input_data, output_data)   
+    build_data_model(spark, input_data, output_data, clean_tables)   
    
     
 if __name__ == '__main__':